@@ -66,8 +66,14 @@ class PNetLin(nn.Module):
 
     def forward(self, in0, in1, retPerLayer=False):
         # v0.0 - original release had a bug, where input was not scaled
-        in0_input, in1_input = (self.scaling_layer(in0), self.scaling_layer(in1)) if self.version == '0.1' else (in0, in1)
-        outs0, outs1 = self.net.forward(in0_input), self.net.forward(in1_input)
+        if in0.shape == in1.shape:
+            # Single backbone pass over both inputs (the backbones have no BatchNorm)
+            inp = torch.cat((in0, in1), dim=0)
+            inp = self.scaling_layer(inp) if self.version == '0.1' else inp
+            outs0, outs1 = zip(*[out.chunk(2, dim=0) for out in self.net.forward(inp)])
+        else:
+            in0_input, in1_input = (self.scaling_layer(in0), self.scaling_layer(in1)) if self.version == '0.1' else (in0, in1)
+            outs0, outs1 = self.net.forward(in0_input), self.net.forward(in1_input)
         feats0, feats1, diffs = {}, {}, {}
 
         for kk in range(self.L):
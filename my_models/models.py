@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 import my_models.model_utils as model_utils
 
@@ -102,16 +103,14 @@ class AudioExpressionNet3(nn.Module):
 
         latent = self.latent_in(latent.clone().view(b, -1))
 
-        # Fully connected
-        expression = []
-        conv_res = conv_res.view(b, self.T, 1, -1)  # [b, T, 1, 64]
-        conv_res = conv_res.transpose(0, 1)  # [T, b, 1, 64]
-        for t in conv_res:
-            z_ = F.leaky_relu(self.adain1(self.fc1(t), latent), 0.02)
-            z_ = F.leaky_relu(self.fc2(z_))
-            z_ = self.fc3(z_)
-            expression.append(self.fc_out(z_))
-        expression = torch.stack(expression, dim=1)  # [b, T, expression_dim]
+        # Fully connected (all time steps at once)
+        latent = latent.unsqueeze(1).expand(b, self.T, -1)
+        latent = latent.reshape(b * self.T, -1)  # [b * T, latent_dim]
+        z_ = F.leaky_relu(self.adain1(self.fc1(conv_res), latent), 0.02)
+        z_ = F.leaky_relu(self.fc2(z_))
+        z_ = self.fc3(z_)
+        expression = self.fc_out(z_)
+        expression = expression.view(b, self.T, -1)  # [b, T, expression_dim]
 
         # expression = expression[:, (self.T // 2):(self.T // 2) + 1]
 
@@ -156,6 +155,21 @@ class FERModelGitHub(nn.Module):
         w = torch.load(RAIDROOT + 'Networks/FERModelGitHub.pt')
         self.load_state_dict(w['net'])
 
+    def fuse_conv_bn(self):
+        """
+        Folds every BatchNorm2d into the preceding Conv2d. Only valid for
+        inference, the running statistics of the BatchNorms are baked in.
+        """
+        assert not self.training, "fuse_conv_bn requires eval mode"
+        layers = []
+        for layer in self.features:
+            if isinstance(layer, nn.BatchNorm2d) and isinstance(layers[-1], nn.Conv2d):
+                layers[-1] = fuse_conv_bn_eval(layers[-1], layer)
+            else:
+                layers.append(layer)
+        self.features = nn.Sequential(*layers)
+        return self
+
     def forward(self, x):
         out = self.features(x)
         out = out.view(out.size(0), -1)
@@ -0,0 +1,23 @@
+"""
+custom_fwd / custom_bwd decorators for the custom ops that work on every
+supported PyTorch version.
+"""
+
+from functools import partial
+
+try:
+    # PyTorch >= 2.4
+    from torch.amp import custom_bwd, custom_fwd
+    custom_fwd = partial(custom_fwd, device_type='cuda')
+    custom_bwd = partial(custom_bwd, device_type='cuda')
+except ImportError:
+    try:
+        # PyTorch >= 1.6
+        from torch.cuda.amp import custom_bwd, custom_fwd
+    except ImportError:
+        # No autocast, nothing to cast
+        def custom_fwd(fwd=None, cast_inputs=None):
+            return fwd if fwd is not None else (lambda f: f)
+
+        def custom_bwd(bwd):
+            return bwd
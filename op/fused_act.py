@@ -3,6 +3,8 @@ from torch import nn
 from torch.autograd import Function
 from torch.utils.cpp_extension import load
 
+from .amp import custom_bwd, custom_fwd
+
 try:
     import fused
 except ModuleNotFoundError:
@@ -43,6 +45,7 @@ class FusedLeakyReLUFunctionBackward(Function):
 
 class FusedLeakyReLUFunction(Function):
     @staticmethod
+    @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, input, bias, negative_slope, scale):
         empty = input.new_empty(0)
         out = fused.fused_bias_act(input, bias, empty, 3, 0, negative_slope, scale)
@@ -53,6 +56,7 @@ class FusedLeakyReLUFunction(Function):
         return out
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         out, = ctx.saved_tensors
 
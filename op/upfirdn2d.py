@@ -2,6 +2,8 @@ import torch
 from torch.autograd import Function
 from torch.utils.cpp_extension import load
 
+from .amp import custom_bwd, custom_fwd
+
 try:
     import upfirdn2d_op
 except ModuleNotFoundError:
@@ -79,6 +81,7 @@ class UpFirDn2dBackward(Function):
 
 class UpFirDn2d(Function):
     @staticmethod
+    @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, input, kernel, up, down, pad):
         up_x, up_y = up
         down_x, down_y = down
@@ -116,6 +119,7 @@ class UpFirDn2d(Function):
         return out
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         kernel, grad_kernel = ctx.saved_tensors
 
@@ -70,12 +70,16 @@ class Projector:
             self.latent_in = initial_latent
         self.latent_in.requires_grad = True
 
+        # Buffer for the noise added to the latent in every step
+        self.latent_noise = torch.empty_like(self.latent_in, device=self.device)
+
         # Find noise inputs.
 
         # Init optimizer
         # self.opt = torch.optim.Adam(
         #     [self.latent_in] + self.noises, lr=self.initial_lr)
-        self.opt = torch.optim.Adam([self.latent_in], lr=self.initial_lr)
+        self.opt = torch.optim.Adam([self.latent_in], lr=self.initial_lr,
+                                    **utils.fused_adam_kwargs())
 
         # Init loss function
         self.lpips = PerceptualLoss(model='net-lin', net='vgg').to(self.device)
@@ -129,8 +133,10 @@ class Projector:
         for i_step in pbar:
             self.cur_step = i_step
             self.step()
-            pbar.set_description(
-                (f'loss: {self.loss.item():.4f}; lr: {self.lr:.4f}'))
+            # Reading the loss syncs with the GPU, only do it every 100 steps
+            if i_step % 100 == 0 or i_step == self.num_steps - 1:
+                pbar.set_description(
+                    (f'loss: {self.loss.item():.4f}; lr: {self.lr:.4f}'))
 
     def step(self):
         # Hyperparameters
@@ -139,9 +145,8 @@ class Projector:
         # Add noise to dlatents
         noise_strength = self.latent_std * self.initial_noise_factor * \
             max(0.0, 1.0 - t / self.noise_ramp_length) ** 2
-        latent_noise = (torch.randn_like(self.latent_in)
-                        * noise_strength).to(self.device)
-        self.latent_expr = self.latent_in + latent_noise
+        self.latent_noise.normal_().mul_(noise_strength)
+        self.latent_expr = self.latent_in + self.latent_noise
 
         # Update learning rate
         self.update_lr(t)
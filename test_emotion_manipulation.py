@@ -25,6 +25,7 @@ class VideoClassifier:
         self.device = device
         self.classifier = FERClassifier(
             softmaxed=True).eval().to(self.device)
+        self.classifier.classifier.fuse_conv_bn()
 
     def __call__(self, video):
         video = video.to(self.device)
@@ -39,6 +40,7 @@ class VideoClassifier2:
         self.device = device
         self.classifier = FERClassifier(
             softmaxed=True).eval().to(self.device)
+        self.classifier.classifier.fuse_conv_bn()
 
     def __call__(self, video):
         video = video.to(self.device)
@@ -5,11 +5,13 @@ import random
 import torch
 import torch.nn.functional as F
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from glob import glob
 from lpips import PerceptualLoss
 from my_models import models, style_gan_2
 from subprocess import Popen, PIPE
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torchvision.utils import save_image, make_grid
 from tqdm import tqdm
@@ -43,17 +45,36 @@ class Solver:
 
         # Define audio encoder
         self.audio_encoder = models.AudioExpressionNet3(args.T).to(self.device).train()
+        # TorchScript the convolutional sub-networks, for PyTorch 1.12 / 1.13
+        # where --compile is not available
+        if self.args.jit:
+            self.audio_encoder.convNet = torch.jit.script(self.audio_encoder.convNet)
+            self.audio_encoder.attentionNet = torch.jit.script(self.audio_encoder.attentionNet)
+        # Wrapped (DDP / compiled) forward of the audio encoder. Checkpoints are
+        # written from the unwrapped module so their keys stay the same.
+        self.encode = self.audio_encoder
+        if self.args.distributed:
+            # attentionNet is skipped for T == 1 and gets no gradients
+            self.encode = DistributedDataParallel(
+                self.encode, device_ids=[args.gpu], find_unused_parameters=args.T == 1)
+        if self.args.compile:
+            self.encode = torch.compile(self.encode, mode=self.args.compile_mode)
 
         # Print # parameters
-        print("# params {} (trainable {})".format(
-            utils.count_params(self.audio_encoder),
-            utils.count_trainable_params(self.audio_encoder)
-        ))
+        if self.args.rank == 0:
+            print("# params {} (trainable {})".format(
+                utils.count_params(self.audio_encoder),
+                utils.count_trainable_params(self.audio_encoder)
+            ))
 
         # Select optimizer and loss criterion
-        self.optim = torch.optim.Adam(self.audio_encoder.parameters(), lr=self.lr)
+        self.optim = torch.optim.Adam(self.audio_encoder.parameters(), lr=self.lr,
+                                      **utils.fused_adam_kwargs())
         self.lpips = PerceptualLoss(model='net-lin', net='vgg', gpu_id=args.gpu)
 
+        # Loss scaling for mixed precision training (no-op if disabled)
+        self.scaler = utils.grad_scaler(enabled=self.args.amp)
+
         if self.args.cont or self.args.test:
             path = self.args.model_path
             self.load(path)
@@ -64,12 +85,21 @@ class Solver:
         # eyes_mask = torch.load('saves/pre-trained/tagesschau_eyes_mask_3std.pt').to(self.device)
         self.image_mask = mouth_mask.clamp(0., 1.)
         # self.image_mask = (mouth_mask + eyes_mask).clamp(0., 1.)
+        self.image_mask_sum = self.image_mask.sum()
 
         # MSE mask
         self.mse_mask = torch.load('saves/pre-trained/mse_mask_var+1.pt')[4:8].unsqueeze(0).to(self.device)
 
+        # Target images are normalized on the GPU (see unpack_data)
+        self.img_mean = torch.tensor([0.5, 0.5, 0.5], device=self.device).view(1, 3, 1, 1)
+        self.img_std = torch.tensor([0.5, 0.5, 0.5], device=self.device).view(1, 3, 1, 1)
+
+        # Sample images are composed and written in a background thread
+        self.sample_writer = ThreadPoolExecutor(max_workers=1)
+        self.sample_future = None
+
         # Set up tensorboard
-        if not self.args.debug and not self.args.test:
+        if not self.args.debug and not self.args.test and self.args.rank == 0:
             tb_dir = self.args.save_dir
             # self.writer = SummaryWriter(tb_dir)
             self.train_writer = utils.HparamWriter(tb_dir + 'train/')
@@ -94,7 +124,8 @@ class Solver:
         print(f"Saving: {save_path}")
 
     def load(self, path):
-        print(f"Loading audio_encoder weights from {path}")
+        if self.args.rank == 0:
+            print(f"Loading audio_encoder weights from {path}")
         checkpoint = torch.load(path, map_location=self.device)
         if type(checkpoint) == dict:
             self.optim.load_state_dict(checkpoint['optim_state_dict'])
@@ -111,17 +142,18 @@ class Solver:
         self.optim.param_groups[0]['lr'] = self.lr
 
     def unpack_data(self, batch):
-        audio = batch['audio'].to(self.device)
-        input_latent = batch['input_latent'].to(self.device)
-        target_latent = batch['target_latent'].to(self.device)
-        target_img = batch['target_img'].to(self.device)
+        audio = batch['audio'].to(self.device, non_blocking=True)
+        input_latent = batch['input_latent'].to(self.device, non_blocking=True)
+        target_latent = batch['target_latent'].to(self.device, non_blocking=True)
+        target_img = batch['target_img'].to(self.device, non_blocking=True)
+        target_img = target_img.sub_(self.img_mean).div_(self.img_std)
 
         aux_input = input_latent[:, 4:8]
 
         return audio, input_latent, aux_input, target_latent, target_img
 
     def forward(self, audio, input_latent, aux_input):
-        latent_offset = self.audio_encoder(audio, aux_input)
+        latent_offset = self.encode(audio, aux_input)
         prediction = input_latent.clone()
         if not self.audio_encoder.training:
             latent_offset *= self.args.test_multiplier
@@ -164,7 +196,7 @@ class Solver:
         elif self.args.image_loss_type == 'l1':
             l1_loss = F.l1_loss(pred_img, target_image, reduction='none')
             l1_loss *= self.image_mask
-            l1_loss = l1_loss.sum() / self.image_mask.sum()
+            l1_loss = l1_loss.sum() / self.image_mask_sum
         else:
             raise NotImplementedError
 
@@ -180,8 +212,9 @@ class Solver:
         return loss_dict
 
     def train(self, data_loaders, n_iters):
-        print("Start training")
-        pbar = tqdm(total=n_iters)
+        if self.args.rank == 0:
+            print("Start training")
+        pbar = tqdm(total=n_iters, disable=self.args.rank != 0)
         i_iter = 0
         pbar_avg_train_loss = 0.
         val_loss = 0.
@@ -204,31 +237,35 @@ class Solver:
                 audio, input_latent, aux_input, target_latent, target_img = self.unpack_data(
                     batch)
 
-                # Encode
-                pred = self.forward(audio, input_latent, aux_input)
+                with torch.autocast('cuda', enabled=self.args.amp):
+                    # Encode
+                    pred = self.forward(audio, input_latent, aux_input)
 
-                # Compute perceptual loss
-                losses = self.get_loss(pred, target_latent, target_img, validate=False)
+                    # Compute perceptual loss
+                    losses = self.get_loss(pred, target_latent, target_img, validate=False)
                 loss = losses['loss']
 
                 # Optimize
-                self.optim.zero_grad()
-                loss.backward()
-                self.optim.step()
+                self.optim.zero_grad(set_to_none=True)
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optim)
+                self.scaler.update()
 
+                # Accumulate on the GPU, losses are only synced to the host for logging
                 for key, value in losses.items():
-                    loss_dict_train[key] += value.item()
-                pbar_avg_train_loss += loss.item()
+                    loss_dict_train[key] += value.detach().float()
+                pbar_avg_train_loss += loss.detach().float()
 
                 self.global_step += 1
                 i_iter += 1
                 pbar.update()
 
-                if self.about_time(self.args.log_val_every):
+                # Only the first process logs the validation loss
+                if self.about_time(self.args.log_val_every) and self.args.rank == 0:
                     loss_dict_val = self.validate(data_loaders)
                     val_loss = loss_dict_val['loss']
 
-                if self.about_time(self.args.update_pbar_every):
+                if self.about_time(self.args.update_pbar_every) and self.args.rank == 0:
                     pbar_avg_train_loss /= self.args.update_pbar_every
                     pbar.set_description('step [{gs}/{ni}] - '
                                          't-loss {tl:.3f} - '
@@ -236,20 +273,20 @@ class Solver:
                                          'lr {lr:.6f}'.format(
                                              gs=self.global_step,
                                              ni=n_iters,
-                                             tl=pbar_avg_train_loss,
+                                             tl=float(pbar_avg_train_loss),
                                              vl=val_loss,
                                              lr=self.lr
                                          ))
                     pbar_avg_train_loss = 0.
                     print("")
 
-                # Logging and evaluating
-                if not self.args.debug:
+                # Logging and evaluating (first process only)
+                if not self.args.debug and self.args.rank == 0:
                     if self.about_time(self.args.log_train_every):
                         for key in loss_dict_train.keys():
                             loss_dict_train[key] /= max(1, float(self.args.log_train_every))
                             self.train_writer.add_scalar(
-                                key, loss_dict_train[key], self.global_step)
+                                key, float(loss_dict_train[key]), self.global_step)
                             loss_dict_train[key] = 0.
 
                     if self.about_time(self.args.log_val_every):
@@ -269,8 +306,12 @@ class Solver:
                 if self.global_step == n_iters:
                     break
 
-        self.save()
-        print('Done.')
+        if self.args.rank == 0:
+            self.save()
+        self.wait_for_sample()
+        self.sample_writer.shutdown(wait=True)
+        if self.args.rank == 0:
+            print('Done.')
 
     def validate(self, data_loaders):
         loss_dict = {
@@ -289,16 +330,17 @@ class Solver:
                 pred = self.forward(audio, input_latent, aux_input)
                 loss = self.get_loss(pred, target_latent, target_img, validate=True)
                 for key, value in loss.items():
-                    loss_dict[key] += value.item()
+                    loss_dict[key] += value
 
+        n_batches = float(len(data_loaders['val']))
         for key in loss_dict.keys():
-            loss_dict[key] /= float(len(data_loaders['val']))
+            loss_dict[key] = float(loss_dict[key]) / n_batches
         return loss_dict
 
     def eval(self, data_loader, sample_name):
         # Unpack batch
         batch = next(iter(data_loader))
-        audio, input_latent, aux_input, target_latent, target_img, _ = self.unpack_data(
+        audio, input_latent, aux_input, target_latent, target_img = self.unpack_data(
             batch)
 
         n_display = min(4, self.args.batch_size)
@@ -321,6 +363,19 @@ class Solver:
                 [target_latent], input_is_latent=True, noise=self.g.noises)
             target_img = utils.downsample_256(target_img)
 
+        self.wait_for_sample()
+        self.sample_future = self.sample_writer.submit(
+            self._save_sample, input_img.cpu(), pred.cpu(), target_img.cpu(),
+            f'{self.args.save_dir}sample/{sample_name}')
+
+    def wait_for_sample(self):
+        # Re-raises any exception from the previous background write
+        if self.sample_future is not None:
+            self.sample_future.result()
+            self.sample_future = None
+
+    @staticmethod
+    def _save_sample(input_img, pred, target_img, path):
         # Normalize images to display
         input_img = make_grid(input_img, normalize=True, range=(-1, 1))
         pred = make_grid(pred, normalize=True, range=(-1, 1))
@@ -328,11 +383,7 @@ class Solver:
         diff = (target_img - pred) * 5
 
         img_tensor = torch.stack((pred, target_img, diff, input_img), dim=0)
-        save_image(
-            img_tensor,
-            f'{self.args.save_dir}sample/{sample_name}',
-            nrow=1
-        )
+        save_image(img_tensor, path, nrow=1)
 
     def test_model(self, paths, n_test, frames, mode=""):
         counter = 0
@@ -429,14 +480,16 @@ def load_data(args):
     if args.overfit:
         train_paths = [train_paths[0]]
         val_paths = train_paths
-        print(f"OVERFITTING ON {train_paths[0][0]}")
+        if args.rank == 0:
+            print(f"OVERFITTING ON {train_paths[0][0]}")
 
-    print("Sample training videos")
-    for i in range(5):
-        print(train_paths[i][0])
-    print(f"Sample validation videos")
-    for i in range(5):
-        print(val_paths[i][0])
+    if args.rank == 0:
+        print("Sample training videos")
+        for i in range(5):
+            print(train_paths[i][0])
+        print(f"Sample validation videos")
+        for i in range(5):
+            print(val_paths[i][0])
 
     train_ds = datasets.AudioVisualDataset(
         paths=train_paths,
@@ -445,9 +498,7 @@ def load_data(args):
         load_latent=True,
         random_inp_latent=args.random_inp_latent,
         T=args.T,
-        normalize=True,
-        mean=[0.5, 0.5, 0.5],
-        std=[0.5, 0.5, 0.5],
+        normalize=False,
         image_size=256,
     )
     val_ds = datasets.AudioVisualDataset(
@@ -457,9 +508,7 @@ def load_data(args):
         load_latent=True,
         random_inp_latent=args.random_inp_latent,
         T=args.T,
-        normalize=True,
-        mean=[0.5, 0.5, 0.5],
-        std=[0.5, 0.5, 0.5],
+        normalize=False,
         image_size=256,
     )
     train_sampler = datasets.RandomAudioSampler(
@@ -467,15 +516,17 @@ def load_data(args):
     val_sampler = datasets.RandomAudioSampler(
         val_paths, args.T, args.batch_size, 50, weighted=True, static_random=args.static_random_inp_latent)
 
-    print(f"Dataset length: Train {len(train_ds)} val {len(val_ds)}")
+    if args.rank == 0:
+        print(f"Dataset length: Train {len(train_ds)} val {len(val_ds)}")
     data_loaders = {
         'train': DataLoader(
             train_ds,
             batch_size=args.batch_size,
             sampler=train_sampler,
             num_workers=4,
-            drop_last=False,
-            pin_memory=True
+            drop_last=True,
+            pin_memory=True,
+            prefetch_factor=4
         ),
         'val': DataLoader(
             val_ds,
@@ -483,7 +534,10 @@ def load_data(args):
             sampler=val_sampler,
             num_workers=4,
             drop_last=False,
-            pin_memory=True
+            pin_memory=True,
+            prefetch_factor=4,
+            # Validation is re-run every log_val_every steps, keep workers alive
+            persistent_workers=True
         )
     }
     return data_loaders, train_paths, val_paths, test_paths
@@ -517,6 +571,11 @@ if __name__ == '__main__':
     parser.add_argument('--random_inp_latent', type=bool, default=False)
     parser.add_argument('--static_random_inp_latent', type=bool, default=False)
     parser.add_argument('--image_loss_type', type=str, default='lpips')  # 'lpips' or 'l1'
+    parser.add_argument('--amp', action='store_true')  # Mixed precision training
+    parser.add_argument('--compile', action='store_true')  # torch.compile the audio encoder
+    parser.add_argument('--compile_mode', type=str, default='max-autotune',
+                        choices=['default', 'reduce-overhead', 'max-autotune'])  # Both reduce-overhead and max-autotune use CUDA graphs
+    parser.add_argument('--jit', action='store_true')  # TorchScript the audio encoder's sub-networks (PyTorch < 2.0, no torch.compile)
 
     parser.add_argument('--test_multiplier', type=float, default=2.0)  # During test time, direction is multiplied with
     parser.add_argument('--test_truncation', type=float, default=.8)  # After multiplication, truncate to mean latent
@@ -548,6 +607,7 @@ if __name__ == '__main__':
 
     if args.cont or args.test:
         assert args.model_path is not None
+    assert not (args.jit and args.compile), "Use either --jit or --compile"
 
     # Correct path
     if args.save_dir[-1] != '/':
@@ -558,18 +618,38 @@ if __name__ == '__main__':
     if args.cont or args.test:
         args.save_dir = '/'.join(args.model_path.split('/')[:-2]) + '/'
 
-    if args.debug:
-        print("DEBUG MODE. NO LOGGING")
-    elif args.test:
-        print("Testing")
-
-    # Select device
+    # Select device, one process per GPU if launched with torchrun
+    args.distributed = 'LOCAL_RANK' in os.environ
+    if args.distributed:
+        args.gpu = int(os.environ['LOCAL_RANK'])
+        torch.distributed.init_process_group('nccl')
+        args.rank = torch.distributed.get_rank()
+    else:
+        args.rank = 0
     args.device = f'cuda:{args.gpu}'
     torch.cuda.set_device(args.device)
 
+    if args.rank == 0:
+        if args.debug:
+            print("DEBUG MODE. NO LOGGING")
+        elif args.test:
+            print("Testing")
+
+    # Input shapes are fixed, let cuDNN benchmark and cache the fastest kernels
+    torch.backends.cudnn.benchmark = True
+    # Allow TF32 tensor cores for matmuls and convolutions (Ampere and newer)
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cudnn.allow_tf32 = True
+
     # Load data
     data_loaders, train_paths, val_paths, test_paths = load_data(args)
 
+    # Same seed for the data splits on every process, but every process has
+    # to draw different training batches
+    random.seed(seed + args.rank)
+    np.random.seed(seed + args.rank)
+    torch.manual_seed(seed + args.rank)
+
     # Init solver
     solver = Solver(args)
 
@@ -602,4 +682,8 @@ if __name__ == '__main__':
         solver.test_model(grid_paths, n_test=-1, frames=-1, mode='')
     else:
         solver.train(data_loaders, args.n_iters)
-        print("Finished training.")
+        if args.rank == 0:
+            print("Finished training.")
+
+    if args.distributed:
+        torch.distributed.destroy_process_group()
@@ -43,8 +43,15 @@ class solverEncoder:
         # Init global step
         self.global_step = 0
 
-        # Define encoder model
+        # Define encoder model (NHWC, so cuDNN can use tensor core kernels directly)
         self.e = resnetEncoder().train().to(self.device)
+        self.e = self.e.to(memory_format=torch.channels_last)
+        # Compiled forward of the encoder. Checkpoints are written from the
+        # uncompiled module so their keys stay the same.
+        if self.args.compile:
+            self.encode = torch.compile(self.e, mode=self.args.compile_mode)
+        else:
+            self.encode = self.e
 
         # Print # parameters
         print("# params {} (trainable {})".format(
@@ -53,9 +60,13 @@ class solverEncoder:
         ))
 
         # Select optimizer and loss criterion
-        self.optim = torch.optim.Adam(self.e.parameters(), lr=self.initial_lr)
+        self.optim = torch.optim.Adam(self.e.parameters(), lr=self.initial_lr,
+                                      **utils.fused_adam_kwargs())
         self.criterion = PerceptualLoss(model='net-lin', net='vgg', gpu_id=args.gpu)
 
+        # Loss scaling for mixed precision training (no-op if disabled)
+        self.scaler = utils.grad_scaler(enabled=self.args.amp)
+
         # Load model and optimizer checkpoint
         if self.args.cont or self.args.test or self.args.run:
             path = self.args.model_path
@@ -75,7 +86,7 @@ class solverEncoder:
         # Encode
         if evaluation:
             self.e.eval()
-        latent_offset = self.e(img)
+        latent_offset = self.encode(img)
         if evaluation:
             self.e.train()
         # Add mean (we only want to compute offset to mean latent)
@@ -125,6 +136,7 @@ class solverEncoder:
 
     def train(self, n_iters, train_loader, val_loader):
         print("Start training")
+        train_loss = 0.
         val_loss = 0.0
         val_img = None
         val_img_gen = None
@@ -135,40 +147,51 @@ class solverEncoder:
         while i_iter < n_iters:
             for batch in train_loader:
                 # Unpack batch
-                img = batch['img'].to(self.device)
+                img = batch['img'].to(self.device, non_blocking=True).contiguous(
+                    memory_format=torch.channels_last)
 
                 # Update learning rate
                 t = self.global_step / n_iters
                 self.update_lr(t)
 
-                loss, img_gen = self.forward(img)
+                with torch.autocast('cuda', enabled=self.args.amp):
+                    loss, img_gen = self.forward(img)
 
                 # Optimize
-                self.optim.zero_grad()
-                loss.backward()
-                self.optim.step()
+                self.optim.zero_grad(set_to_none=True)
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optim)
+                self.scaler.update()
+
+                # Accumulate on the GPU, the loss is only synced to the host for logging
+                train_loss += loss.detach().float()
 
                 self.global_step += 1
                 i_iter += 1
                 pbar.update()
 
-                # Update progress bar
-                pbar.set_description('Step {gs} - '
-                                     'Train loss {tl:.4f} - '
-                                     'Val loss {vl:.4f} - '
-                                     'lr {lr:.4f}'.format(
-                                         gs=self.global_step,
-                                         tl=loss,
-                                         vl=val_loss,
-                                         lr=self.lr
-                                     ))
+                if self.global_step % self.args.log_train_every == 0:
+                    train_loss = float(train_loss) / self.args.log_train_every
 
-                if not self.args.debug:
-                    if self.global_step % self.args.log_train_every == 0:
-                        self.writer.add_scalars('loss', {'train': loss}, self.global_step)
+                    # Update progress bar
+                    pbar.set_description('Step {gs} - '
+                                         'Train loss {tl:.4f} - '
+                                         'Val loss {vl:.4f} - '
+                                         'lr {lr:.4f}'.format(
+                                             gs=self.global_step,
+                                             tl=train_loss,
+                                             vl=val_loss,
+                                             lr=self.lr
+                                         ))
 
+                    if not self.args.debug:
+                        self.writer.add_scalars('loss', {'train': train_loss}, self.global_step)
+                    train_loss = 0.
+
+                if not self.args.debug:
                     if self.global_step % self.args.log_val_every == 0:
                         val_loss, val_img, val_img_gen = self.eval(val_loader)
+                        val_loss = float(val_loss)
                         self.writer.add_scalars('loss', {'val': val_loss}, self.global_step)
 
                     if self.global_step % self.args.save_every == 0:
@@ -208,7 +231,8 @@ class solverEncoder:
     def eval(self, val_loader):
         # Train_sample
         batch = next(iter(val_loader))
-        img = batch['img'].to(self.device)
+        img = batch['img'].to(self.device, non_blocking=True).contiguous(
+            memory_format=torch.channels_last)
 
         with torch.no_grad():
             # Forward
@@ -310,6 +334,10 @@ if __name__ == '__main__':
 
     parser.add_argument('--batch_size', type=int, default=4)  # 4
     parser.add_argument('--lr', type=int, default=0.01)  # 0.01
+    parser.add_argument('--amp', action='store_true')  # Mixed precision training
+    parser.add_argument('--compile', action='store_true')  # torch.compile the encoder
+    parser.add_argument('--compile_mode', type=str, default='max-autotune',
+                        choices=['default', 'reduce-overhead', 'max-autotune'])  # Both reduce-overhead and max-autotune use CUDA graphs
     parser.add_argument('--n_iters', type=int, default=50000)  # 150000
     parser.add_argument('--log_train_every', type=int, default=100)  # 1
     parser.add_argument('--log_val_every', type=int, default=1000)   # 1000
@@ -341,6 +369,12 @@ if __name__ == '__main__':
     args.device = device
     torch.cuda.set_device(args.device)
 
+    # Input shapes are fixed, let cuDNN benchmark and cache the fastest kernels
+    torch.backends.cudnn.benchmark = True
+    # Allow TF32 tensor cores for matmuls and convolutions (Ampere and newer)
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cudnn.allow_tf32 = True
+
     # Data loading
     ds = datasets.ImageDataset(
         root_path=DATAROOT + "AudioVisualDataset/Aligned256/",
@@ -350,9 +384,11 @@ if __name__ == '__main__':
         image_size=256
     )
     train_loader = torch.utils.data.DataLoader(
-        ds, batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True)
+        ds, batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True,
+        drop_last=True, prefetch_factor=4, persistent_workers=True)
     val_loader = torch.utils.data.DataLoader(
-        ds, batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True)
+        ds, batch_size=args.batch_size, shuffle=True, num_workers=4, pin_memory=True,
+        prefetch_factor=4, persistent_workers=True)
     print(len(ds))
 
     # Init solver
@@ -4,6 +4,7 @@ File for general usefull functions which are not specific to a certain module
 
 import cv2
 import face_alignment
+import inspect
 import numpy as np
 import os
 import torch
@@ -71,6 +72,20 @@ def count_trainable_params(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
 
+def fused_adam_kwargs():
+    """ Returns {'fused': True} if this PyTorch build has a fused Adam """
+    if 'fused' in inspect.signature(torch.optim.Adam).parameters:
+        return {'fused': True}
+    return {}
+
+
+def grad_scaler(enabled=True):
+    """ Returns a CUDA GradScaler, torch.cuda.amp.GradScaler is deprecated """
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
 class VideoAligner:
     def __init__(self, device):
         # Init face tracking